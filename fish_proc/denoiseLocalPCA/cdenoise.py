@@ -4,16 +4,14 @@ import numpy as np
 def low_rank_svd(img, rank_k):
     from sklearn.utils.extmath import randomized_svd
     dx, dy, dt = img.shape
-    vec_img = img.reshape(dx*dy, dt)
+    vec_img = img.reshape(dx*dy, dt).astype(np.float32, copy=False)
     U, s, Vt = randomized_svd(vec_img, n_components=rank_k, n_iter=7, random_state=None)
-    return U.dot(np.diag(s).dot(Vt)).reshape((dx, dy, dt))
+    # scale the columns of U instead of building diag(s)
+    return (U*s).dot(Vt).reshape((dx, dy, dt))
 
 def pad_index(arr, overlap_step, max_value):
     if overlap_step>0:
-        arr1 = [_-overlap_step for _ in arr]
-        arr2 = [_+overlap_step for _ in arr]
-        for _ in arr2:
-            arr1.append(_)
+        arr1 = [_-overlap_step for _ in arr] + [_+overlap_step for _ in arr]
         arr1[0] = arr1[0][arr1[0]>=0]
         arr1[-1] = arr1[-1][arr1[-1]<max_value]
         return arr1
@@ -24,45 +22,127 @@ def split_to_blocks(nsize, nblocks, overlap_step):
     assert len(nsize) == len(overlap_step), print("lengths not matched")
     arr = []
     for nsize_, nblock_, overlap_ in zip(nsize, nblocks, overlap_step):
-        arr_ = np.array_split(range(nsize_), nblock_)
+        arr_ = np.array_split(np.arange(nsize_), nblock_)
         arr.append(pad_index(arr_, overlap_, nsize_))
     return arr
 
+def index_arr_bounds(arrs):
+    # (start, stop) of each index array, computed once per axis
+    return [np.array([[_.min(), _.max()+1] for _ in arr_], dtype=np.int64) for arr_ in arrs]
+
+def get_block_slices_from_index_arr(arrs):
+    # light-weight (z, x, y) slice tuples, blocks are only cut from the stack when needed
+    z_bounds, x_bounds, y_bounds = index_arr_bounds(arrs)
+    return [(slice(zs, ze), slice(xs, xe), slice(ys, ye))
+            for zs, ze in z_bounds for xs, xe in x_bounds for ys, ye in y_bounds]
+
+def get_block_view(imgStack, block_slice):
+    return imgStack[block_slice]
+
 def get_blocks_from_index_arr(imgStack, arrs):
-    blocks = []
-    for z_arr in arrs[0]:
-        for x_arr in arrs[1]:
-            for y_arr in arrs[2]:
-                block_ = imgStack[z_arr.min():z_arr.max()+1, x_arr.min():x_arr.max()+1, y_arr.min():y_arr.max()+1, :]
-                blocks.append([block_, z_arr, x_arr, y_arr])
-    return blocks
-
-def run_single(blocks, maxlag=5, confidence=0.999, greedy=False, fudge_factor=0.99, mean_th_factor=1.15,
-               U_update=False, min_rank=1, stim_knots=None, stim_delta=200):
+    return [get_block_view(imgStack, sl) for sl in get_block_slices_from_index_arr(arrs)]
 
+def gpca_indexed(patch_index, maxlag=5, confidence=0.999, greedy=False, fudge_factor=0.99, mean_th_factor=1.15,
+                 U_update=False, min_rank=1, stim_knots=None, stim_delta=200):
     from . import greedyPCA as gpca
+    patch = patch_index[0]
+    nblock = patch_index[1]
+    c_out = gpca.denoise_patch(patch, maxlag=maxlag, confidence=confidence, greedy=greedy,
+                               fudge_factor=fudge_factor, mean_th_factor=mean_th_factor,
+                               U_update=U_update, min_rank=min_rank, stim_knots=stim_knots,
+                               stim_delta=stim_delta)
+    return nblock, c_out
+
+def imap_chunksize(nargs, cpu_count):
+    return max(1, nargs//(cpu_count*4))
+
+def run_single(imgStack, block_slices, maxlag=5, confidence=0.999, greedy=False, fudge_factor=0.99, mean_th_factor=1.15,
+               U_update=False, min_rank=1, stim_knots=None, stim_delta=200):
+
     import time
     import multiprocessing
     from functools import partial
 
-    func = partial(gpca.denoise_patch, maxlag=maxlag, confidence=confidence, greedy=greedy,
+    func = partial(gpca_indexed, maxlag=maxlag, confidence=confidence, greedy=greedy,
                                   fudge_factor=fudge_factor, mean_th_factor=mean_th_factor, U_update=U_update,
                                   min_rank=min_rank, stim_knots=stim_knots, stim_delta=stim_delta)
 
     start=time.time()
     cpu_count = max(1, multiprocessing.cpu_count()-2)
-    args=[patch[0] for patch in blocks]
+    nblocks = len(block_slices)
+    args=([get_block_view(imgStack, sl), n_] for n_, sl in enumerate(block_slices))
     start=time.time()
     pool = multiprocessing.Pool(cpu_count)
-    print('Running %d blocks in %d cpus'%(len(blocks), cpu_count))#if verbose else 0
+    print('Running %d blocks in %d cpus'%(nblocks, cpu_count))#if verbose else 0
     # define params in function
-    c_outs = pool.map(func, args)
+    Yds = [None]*nblocks
+    vtids = [None]*nblocks
+    # stream results back as they finish instead of holding all outputs in a list
+    for n_, (Yd, vtid) in pool.imap_unordered(func, args, chunksize=imap_chunksize(nblocks, cpu_count)):
+        Yds[n_] = Yd
+        vtids[n_] = vtid
     pool.close()
     pool.join()
-    Yds = [out_[0] for out_ in c_outs]
-    vtids = [out_[1] for out_ in c_outs]
     vtids = np.asarray(vtids).astype('int')
-    print('Blocks(=%d) run time: %f'%(len(blocks),time.time()-start))
+    print('Blocks(=%d) run time: %f'%(nblocks,time.time()-start))
+    return Yds, vtids
+
+def gpca_shm(slice_index, shm_name='', shape=None, dtype=None, **kwargs):
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        # zero-copy view of the block in the shared stack
+        patch = np.ndarray(shape, dtype=dtype, buffer=shm.buf)[slice_index[0]]
+        c_out = gpca_indexed([patch, slice_index[1]], **kwargs)
+        del patch
+    finally:
+        shm.close()
+    return c_out
+
+def run_single_shm(imgStack, block_slices, maxlag=5, confidence=0.999, greedy=False, fudge_factor=0.99, mean_th_factor=1.15,
+               U_update=False, min_rank=1, stim_knots=None, stim_delta=200):
+    """
+    Same as run_single, but blocks are read by the workers from a copy of imgStack
+    in shared memory, so only the block slices are pickled.
+    """
+    import time
+    import multiprocessing
+    from functools import partial
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:
+        # python < 3.8: blocks are pickled to the workers instead
+        return run_single(imgStack, block_slices, maxlag=maxlag, confidence=confidence, greedy=greedy,
+                          fudge_factor=fudge_factor, mean_th_factor=mean_th_factor, U_update=U_update,
+                          min_rank=min_rank, stim_knots=stim_knots, stim_delta=stim_delta)
+
+    slices = block_slices
+    start=time.time()
+    cpu_count = max(1, multiprocessing.cpu_count()-2)
+    shm = shared_memory.SharedMemory(create=True, size=imgStack.nbytes)
+    try:
+        arr = np.ndarray(imgStack.shape, dtype=imgStack.dtype, buffer=shm.buf)
+        arr[:] = imgStack
+        del arr
+        func = partial(gpca_shm, shm_name=shm.name, shape=imgStack.shape, dtype=imgStack.dtype,
+                       maxlag=maxlag, confidence=confidence, greedy=greedy,
+                       fudge_factor=fudge_factor, mean_th_factor=mean_th_factor, U_update=U_update,
+                       min_rank=min_rank, stim_knots=stim_knots, stim_delta=stim_delta)
+        args=[[sl, n_] for n_, sl in enumerate(slices)]
+        pool = multiprocessing.Pool(cpu_count)
+        print('Running %d blocks in %d cpus'%(len(slices), cpu_count))#if verbose else 0
+        Yds = [None]*len(slices)
+        vtids = [None]*len(slices)
+        for n_, (Yd, vtid) in pool.imap_unordered(func, args, chunksize=imap_chunksize(len(args), cpu_count)):
+            Yds[n_] = Yd
+            vtids[n_] = vtid
+        pool.close()
+        pool.join()
+    finally:
+        shm.close()
+        shm.unlink()
+    vtids = np.asarray(vtids).astype('int')
+    print('Blocks(=%d) run time: %f'%(len(slices),time.time()-start))
     return Yds, vtids
 
 def gpca_to_file(patch_index, files='', maxlag=5, confidence=0.999, greedy=False, fudge_factor=0.99, mean_th_factor=1.15,
@@ -77,7 +157,7 @@ def gpca_to_file(patch_index, files='', maxlag=5, confidence=0.999, greedy=False
     np.savez(files + '%06d'%(nfile), Yds=c_out[0], vtids=c_out[1])
     return None
 
-def run_single_to_files(blocks, files, maxlag=5, confidence=0.999, greedy=False, fudge_factor=0.99, mean_th_factor=1.15,
+def run_single_to_files(imgStack, block_slices, files, maxlag=5, confidence=0.999, greedy=False, fudge_factor=0.99, mean_th_factor=1.15,
                U_update=False, min_rank=1, stim_knots=None, stim_delta=200):
     import time
     import multiprocessing
@@ -89,38 +169,53 @@ def run_single_to_files(blocks, files, maxlag=5, confidence=0.999, greedy=False,
 
     start=time.time()
     cpu_count = multiprocessing.cpu_count()
-    args=[[patch[0], n_] for n_, patch in enumerate(blocks)]
+    nblocks = len(block_slices)
+    args=([get_block_view(imgStack, sl), n_] for n_, sl in enumerate(block_slices))
     start=time.time()
     pool = multiprocessing.Pool(cpu_count)
-    print('Running %d blocks in %d cpus'%(len(blocks), cpu_count))#if verbose else 0
+    print('Running %d blocks in %d cpus'%(nblocks, cpu_count))#if verbose else 0
     # define params in function
-    pool.map(func, args)
+    # each worker writes its own file, so completion order does not matter
+    for _ in pool.imap_unordered(func, args, chunksize=imap_chunksize(nblocks, cpu_count)):
+        pass
     pool.close()
     pool.join()
-    print('Blocks(=%d) run time: %f'%(len(blocks),time.time()-start))
+    print('Blocks(=%d) run time: %f'%(nblocks,time.time()-start))
     return None
 
 
-def combine_blocks(block_data, block_size, block_corrs):
-    block_mat = np.zeros(block_size)
-    block_count = block_mat.copy().astype(np.int)
-    for ndata, ncorr in zip(block_data, block_corrs):
-        _, z_arr, x_arr, y_arr = ncorr
-        block_mat[z_arr.min():z_arr.max()+1, x_arr.min():x_arr.max()+1, y_arr.min():y_arr.max()+1, :] += ndata
-        block_count[z_arr.min():z_arr.max()+1, x_arr.min():x_arr.max()+1, y_arr.min():y_arr.max()+1, :] += 1
+def combine_blocks(block_data, block_size, block_slices):
+    block_mat = np.zeros(block_size, dtype=np.float32)
+    # overlap counts do not change along time, keep a singleton time axis
+    # a voxel is covered by at most a few overlapping blocks
+    block_count = np.zeros(tuple(block_size[:-1])+(1,), dtype=np.uint8)
+    for ndata, sl in zip(block_data, block_slices):
+        block_mat[sl] += ndata
+        block_count[sl] += 1
     return block_mat, block_count
 
 
-def combine_blocks_from_files(block_data_files, block_size, block_corrs):
-    block_mat = np.zeros(block_size)
-    block_count = block_mat.copy().astype(np.int)
-    block_ranks = block_mat.copy().astype(np.int)
-    for nfile, ncorr in zip(block_data_files, block_corrs):
-        _ = np.load(nfile)
-        ndata = _['Yds']
-        nrank = _['vtids'].astype('int')
-        _, z_arr, x_arr, y_arr = ncorr
-        block_mat[z_arr.min():z_arr.max()+1, x_arr.min():x_arr.max()+1, y_arr.min():y_arr.max()+1, :] += ndata
-        block_count[z_arr.min():z_arr.max()+1, x_arr.min():x_arr.max()+1, y_arr.min():y_arr.max()+1, :] += 1
-        block_ranks[z_arr.min():z_arr.max()+1, x_arr.min():x_arr.max()+1, y_arr.min():y_arr.max()+1, :] += nrank
+def load_block_file(nfile):
+    with np.load(nfile) as _:
+        return _['Yds'], _['vtids'].astype('int')
+
+
+def combine_blocks_from_files(block_data_files, block_size, block_slices, prefetch=4):
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+    block_mat = np.zeros(block_size, dtype=np.float32)
+    block_count = np.zeros(tuple(block_size[:-1])+(1,), dtype=np.uint8)
+    block_ranks = np.zeros(tuple(block_size[:-1])+(1,), dtype=np.int16)
+    nblocks = min(len(block_data_files), len(block_slices))
+    block_data_files = list(block_data_files)[:nblocks]
+    # keep the next few files loading while the current one is accumulated
+    with ThreadPoolExecutor(max_workers=prefetch) as ex:
+        futures = deque(ex.submit(load_block_file, nfile) for nfile in block_data_files[:prefetch])
+        for n_, sl in enumerate(block_slices[:nblocks]):
+            ndata, nrank = futures.popleft().result()
+            if n_+prefetch < len(block_data_files):
+                futures.append(ex.submit(load_block_file, block_data_files[n_+prefetch]))
+            block_mat[sl] += ndata
+            block_count[sl] += 1
+            block_ranks[sl] += nrank
     return block_mat, block_count, block_ranks
@@ -198,10 +198,12 @@ def wnoise_acov_CI(L,
     # th1 = 0
     #print 'confidence is {}'.format(confidence)
     covs_ht = np.zeros(shape=(n,))
-    for sample in np.arange(n):
-        ht_data = np.random.randn(L)
-        covdata = tools_.axcov(ht_data, maxlag)[maxlag:]/ht_data.var()
-        covs_ht[sample] = covdata.mean()
+    # batches of vectors share one FFT call, bounded to limit memory
+    batch = max(1, min(n, 2**22//L))
+    for sample in np.arange(0, n, batch):
+        ht_data = np.random.randn(min(batch, n-sample), L)
+        covdata = tools_.axcov_rows(ht_data, maxlag)[:, maxlag:]/ht_data.var(axis=1, keepdims=True)
+        covs_ht[sample:sample+len(ht_data)] = covdata.mean(axis=1)
     mean_th = mean_confidence_interval(covs_ht, confidence)
     return mean_th
 
@@ -246,14 +248,14 @@ def vector_acov(Vt,
     keep = []
     num_components = Vt.shape[0]
     print('mean_th is %s'%mean_th) if verbose else 0
+    # standarize and normalize all rows, then compute their ACFs in one batch
+    V = (Vt - Vt.mean(axis=1, keepdims=True))/Vt.std(axis=1, keepdims=True)
+    V_cov = tools_.axcov_rows(V, maxlag)[:, maxlag:]/V.var(axis=1, keepdims=True)
+    V_cov_mean = V_cov.mean(axis=1)
     for vector in range(0, num_components):
-        # standarize and normalize
-        vi = Vt[vector, :]
-        vi =(vi - vi.mean())/vi.std()
-        print('vi mean = %.3f var = %.3f'%(vi.mean(),vi.var())) if verbose else 0
-        vi_cov = tools_.axcov(vi, maxlag)[maxlag:]/vi.var()
-        print(vi_cov.mean()) if verbose else 0
-        if vi_cov.mean() < mean_th:
+        print('vi mean = %.3f var = %.3f'%(V[vector].mean(),V[vector].var())) if verbose else 0
+        print(V_cov_mean[vector]) if verbose else 0
+        if V_cov_mean[vector] < mean_th:
             if iterate is True:
                 break
         else:
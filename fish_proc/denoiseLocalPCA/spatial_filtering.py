@@ -1,30 +1,21 @@
 import numpy as np
 import scipy as sp
-from ..utils.snr import local_correlations_fft
+import scipy.linalg
+from functools import lru_cache
 from ..utils.noise_estimator import get_noise_fft
+from ..utils.noise_estimator import noise_estimator as utils_noise_estimator
 
 def noise_estimator(Y,range_ff=[0.25,0.5],method='logmexp'):
+    # batched Welch of utils.noise_estimator, pixels flattened in 'C' order
+    # so time stays the contiguous last axis
     dims = Y.shape
     if len(dims)>2:
-        V_hat = Y.reshape((np.prod(dims[:2]),dims[2]),order='F')
+        V_hat = Y.reshape((np.prod(dims[:2]),dims[2]))
     else:
-        V_hat = Y.copy()
-    sns = []
-    for i in range(V_hat.shape[0]):
-        ff, Pxx = sp.signal.welch(V_hat[i,:],nperseg=min(256,dims[-1]))
-        ind1 = ff > range_ff[0]
-        ind2 = ff < range_ff[1]
-        ind = np.logical_and(ind1, ind2)
-        Pxx_ind = Pxx[ind]
-        sn = {
-            'mean': lambda Pxx_ind: np.sqrt(np.mean(np.divide(Pxx_ind, 2))),
-            'median': lambda Pxx_ind: np.sqrt(np.median(np.divide(Pxx_ind, 2))),
-            'logmexp': lambda Pxx_ind: np.sqrt(np.exp(np.mean(np.log(np.divide(Pxx_ind, 2)))))
-        }[method](Pxx_ind)
-        sns.append(sn)
-    sns = np.asarray(sns)
+        V_hat = Y
+    sns = utils_noise_estimator(V_hat,range_ff=range_ff,method=method)
     if len(dims)>2:
-        sns = sns.reshape(dims[:2],order='F')
+        sns = sns.reshape(dims[:2])
     return sns
 
 def covariance_matrix(Y):
@@ -35,90 +26,307 @@ def covariance_matrix(Y):
     # matrix where every variable has zero mean
     # divided by the number of degrees of freedom
     """
+    from scipy.linalg.blas import dsyrk, ssyrk
     num_rvs , num_obs = Y.shape
     w = Y - Y.mean(1)[:, np.newaxis]
-    Cy = w.dot(w.T)/(num_obs - 1)
+    if w.dtype not in (np.float32, np.float64):
+        return w.dot(w.T)/(num_obs - 1)
+    # symmetric rank-k update computes only the upper triangle,
+    # w.T is the Fortran-ordered view of w so blas gets it without a copy
+    syrk = ssyrk if w.dtype == np.float32 else dsyrk
+    Cy = syrk(1.0/(num_obs - 1), w.T, trans=1, lower=0)
+    Cy += np.triu(Cy, 1).T
     return Cy
 
 
-def spatial_filter_image(Y_new, gHalf=[2,2], sn=None):
+def lag_covariances(Y_, gHalf=[2,2], out=None):
+    """
+    Covariance along time between every pixel and its neighbours,
+    computed once for the whole image instead of once per window.
+
+    Parameters:
+    ----------
+    Y_:         np.array (d1 x d2 x T)
+                mean subtracted movie
+    gHalf:      list (2,)
+                half size of the filter window
+    out:        np.array, optional
+                preallocated output
+
+    Outputs:
+    -------
+    C:          np.array (4*gHalf[0]+1 x 4*gHalf[1]+1 x d1 x d2)
+                C[dy+2*gHalf[0], dx+2*gHalf[1], i, j] = cov(Y_[i,j], Y_[i+dy,j+dx])
+                zero where the neighbour is outside the image
+    """
+    d1, d2, T = Y_.shape
+    l0, l1 = 2*gHalf[0], 2*gHalf[1]
+    if out is None:
+        C = np.zeros((2*l0+1, 2*l1+1, d1, d2), dtype=Y_.dtype)
+    else:
+        C = out
+        C[:] = 0
+    for dy in range(-l0, l0+1):
+        for dx in range(-l1, l1+1):
+            i0, i1 = max(0, -dy), min(d1, d1-dy)
+            j0, j1 = max(0, -dx), min(d2, d2-dx)
+            if i0 >= i1 or j0 >= j1:
+                continue
+            C[dy+l0, dx+l1, i0:i1, j0:j1] = np.einsum('ijt,ijt->ij',
+                Y_[i0:i1, j0:j1], Y_[i0+dy:i1+dy, j0+dx:j1+dx])/(T-1)
+    return C
+
+
+def window_pixels(h, w):
+    """
+    Local (row, column) of the pixels of a h x w window in 'C' order
+    """
+    return np.repeat(np.arange(h), w), np.tile(np.arange(w), h)
+
+
+def window_bounds(n, g):
+    """
+    Lookup tables of the window start and stop along an axis of size n
+    for half size g
+    """
+    idx = np.arange(n)
+    return np.maximum(idx - g, 0), np.minimum(idx + g + 1, n)
+
+
+@lru_cache(maxsize=32)
+def window_lag_index(h, w, g0, g1, d1, d2):
+    """
+    Flat index into the lag covariances (see lag_covariances) of the
+    covariance matrix of the h x w window with its corner at (0, 0).
+    Only the corner offset i_lo*d2 + j_lo changes between windows of the
+    same shape, so the index is built once per shape (mostly one, the full
+    (2*g0+1) x (2*g1+1) window of the interior pixels).
+    """
+    aa, bb = window_pixels(h, w)
+    dy = aa[np.newaxis,:] - aa[:,np.newaxis] + 2*g0
+    dx = bb[np.newaxis,:] - bb[:,np.newaxis] + 2*g1
+    index_ = ((dy*(4*g1+1) + dx)*d1 + aa[:,np.newaxis])*d2 + bb[:,np.newaxis]
+    index_.setflags(write=False)
+    return index_
+
+
+def window_covariances(C, i_lo, j_lo, h, w, gHalf=[2,2]):
+    """
+    Gather the covariance matrices (n x hw x hw, pixels in 'C' order) of the
+    h x w windows with top-left corners (i_lo, j_lo) from the lag
+    covariances C given by lag_covariances.
+    """
+    d1, d2 = C.shape[2:]
+    index_ = window_lag_index(int(h), int(w), gHalf[0], gHalf[1], d1, d2)
+    corner = np.asarray(i_lo)*d2 + np.asarray(j_lo)
+    return np.take(C.reshape(-1), corner[:,np.newaxis,np.newaxis] + index_)
+
+
+def wiener_weights(Cy, rhs):
+    """
+    Solve Cy hat_k = rhs for a stack of windows (Cy: n x k x k, rhs: n x k)
+    with one batched LAPACK call.
+    A ridge of 1e-6 times the mean variance keeps every Cy with nonzero
+    variance positive definite, degenerate (non-finite) windows come back
+    as non-finite rows instead of raising for the whole batch.
+    """
+    k = Cy.shape[-1]
+    ridge = 1e-6*np.trace(Cy, axis1=1, axis2=2)/k
+    A = Cy + ridge[:,np.newaxis,np.newaxis]*np.eye(k, dtype=Cy.dtype)
+    return np.linalg.solve(A, rhs[...,np.newaxis])[...,0]
+
+
+def spatial_filter_image(Y_new, gHalf=[2,2], sn=None, is_mp=True):
     """
     Apply a wiener filter to image Y_new d1 x d2 x T
+    Pixels are independent, rows of pixels are split over processes if is_mp
     """
-    mean_ = Y_new.mean(axis=2,keepdims=True)
+    import multiprocessing as mp
+    # the whole filter runs in single precision
+    mean_ = Y_new.mean(axis=2,keepdims=True,dtype=np.float64).astype(np.float32)
     if sn is None:
         sn = noise_estimator(Y_new - mean_, method='logmexp')
     else:
         print('sn given')
-    # Cnb = cm.local_correlations(Y_new)
-    Cnb = local_correlations_fft(Y_new)
-    maps = [Cnb.min(), Cnb.max()]
+    # windows take float32 views of one noise map, no per-pixel copies
+    sn = np.asarray(sn, dtype=np.float32)
+    # with fork, workers inherit anonymous shared memory: the movie and the
+    # lag covariances are written there once and never pickled
+    use_mp = is_mp and mp.cpu_count() > 1 and 'fork' in mp.get_all_start_methods()
+    alloc = shared_empty if use_mp else np.empty
+    Y_ = alloc(Y_new.shape, np.float32)
+    np.subtract(Y_new, mean_, out=Y_, casting='same_kind')
+    # all window covariances come from one pass over the image
+    C_shape = (4*gHalf[0]+1, 4*gHalf[1]+1)+Y_new.shape[:2]
+    C_lags = lag_covariances(Y_, gHalf=gHalf, out=alloc(C_shape, np.float32))
+
+    rows = np.arange(Y_new.shape[0])
+    if use_mp:
+        Y_new3, k_hats = spatial_filter_rows_mp(rows, Y_, mean_, sn, C_lags, gHalf=gHalf)
+    else:
+        Y_new3, k_hats = spatial_filter_rows(rows, Y_=Y_, mean_=mean_, sn=sn, C_lags=C_lags, gHalf=gHalf)
+    return Y_new3, list(k_hats)
 
-    Y_new2 = Y_new.copy()
-    Y_new3 = np.zeros(Y_new.shape)#Y_new.copy()
 
-    d = np.shape(Y_new)
-    n_pixels = np.prod(d[:-1])
+def shared_empty(shape, dtype):
+    """
+    Uninitialized array on anonymous shared memory, visible to (and writable
+    by) processes forked after it is created
+    """
+    import mmap
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape))
+    buf = mmap.mmap(-1, max(1, size*dtype.itemsize))
+    return np.frombuffer(buf, dtype=dtype, count=size).reshape(shape)
 
-    center = np.zeros((n_pixels,2)) #2D arrays
 
-    k_hats=[]
-    for pixel in np.arange(n_pixels):
-        if pixel % 1e3==0:
-            print('first k pixels %d'%pixel)
-        ij = np.unravel_index(pixel,d[:2])
-        for c, i in enumerate(ij):
-            center[pixel, c] = i
-        # Get surrounding area
-        ijSig = [[np.maximum(ij[c] - gHalf[c], 0), np.minimum(ij[c] + gHalf[c] + 1, d[c])]
-                for c in range(len(ij))]
+# arrays handed to forked workers of spatial_filter_rows_mp
+_shared_arrays = {}
 
-        Y_curr = np.array(Y_new[[slice(*a) for a in ijSig]].copy(),dtype=np.float32)
-        sn_curr = np.array(sn[[slice(*a) for a in ijSig]].copy(),dtype=np.float32)
-        cc1 = ij[0]-ijSig[0][0]
-        cc2 = ij[1]-ijSig[1][0]
-        neuron_indx = int(np.ravel_multi_index((cc1,cc2),Y_curr.shape[:2],order='F'))
-        Y_out , k_hat = spatial_filter_block(Y_curr, sn=sn_curr,
-                maps=maps, neuron_indx=neuron_indx)
-        Y_new3[ij[0],ij[1],:] = Y_out[cc1,cc2,:]
-        k_hats.append(k_hat)
 
-    return Y_new3, k_hats
+def spatial_filter_rows_mp(rows, Y_, mean_, sn, C_lags, gHalf=[2,2]):
+    """
+    spatial_filter_rows over chunks of rows in a pool of forked processes.
+    Y_ and C_lags should be on shared memory (see shared_empty), the workers
+    inherit them and write their rows straight to a shared output.
+    """
+    import multiprocessing as mp
+    from functools import partial
+    Y_out = shared_empty((len(rows),)+Y_.shape[1:], np.float32)
+    _shared_arrays.update(Y_=Y_, mean_=mean_, sn=sn, C_lags=C_lags, Y_out=Y_out)
+    try:
+        n_chunks = min(mp.cpu_count(), len(rows))
+        print(f'Number of processes to parallel: {n_chunks}')
+        pool = mp.get_context('fork').Pool(n_chunks)
+        k_hats = pool.map(partial(spatial_filter_rows_forked, row0=rows[0], gHalf=gHalf),
+                          np.array_split(rows, n_chunks))
+        pool.close()
+        pool.join()
+    finally:
+        _shared_arrays.clear()
+    return Y_out, np.concatenate(k_hats)
 
 
-def spatial_filter_block(data,sn=None,maps=None,neuron_indx=None):
+def spatial_filter_rows_forked(rows, row0=0, gHalf=[2,2]):
+    """
+    Worker of spatial_filter_rows_mp: filter rows and write them to the shared output
+    """
+    arrs = _shared_arrays
+    Y_rows, k_hats = spatial_filter_rows(rows, Y_=arrs['Y_'], mean_=arrs['mean_'], sn=arrs['sn'],
+                                         C_lags=arrs['C_lags'], gHalf=gHalf)
+    arrs['Y_out'][rows-row0] = Y_rows
+    return k_hats
+
+
+def spatial_filter_rows(rows, Y_=None, mean_=None, sn=None, C_lags=None, gHalf=[2,2], batch_size=4096):
+    """
+    Wiener filter of the pixels in rows of the mean subtracted movie Y_ (d1 x d2 x T),
+    C_lags are the lag covariances of Y_ (see lag_covariances).
+    Windows of the same shape are solved together in batches of batch_size pixels.
+    """
+    d1, d2, T = Y_.shape
+    ii = np.repeat(rows, d2)
+    jj = np.tile(np.arange(d2), len(rows))
+    # Get surrounding area from per-axis lookup tables
+    y_lo, y_hi = window_bounds(d1, gHalf[0])
+    x_lo, x_hi = window_bounds(d2, gHalf[1])
+    i_lo, j_lo = y_lo[ii], x_lo[jj]
+    hh, ww = y_hi[ii] - i_lo, x_hi[jj] - j_lo
+    # center pixel of each window in 'C' order
+    neuron_indx = (ii - i_lo)*ww + (jj - j_lo)
+    # pixels sorted by window shape, one pass instead of a mask per shape
+    shape_id = hh*(2*gHalf[1]+2) + ww
+    order = np.argsort(shape_id, kind='stable')
+    _, starts = np.unique(shape_id[order], return_index=True)
+
+    Y_rows = np.zeros((len(ii), T), dtype=np.float32)
+    k_hats = np.empty(len(ii), dtype=object)
+    pixel_var = C_lags[2*gHalf[0], 2*gHalf[1]]
+    # mean square of the raw pixels, the scale the variance is compared to
+    pixel_msq = pixel_var + np.square(mean_[..., 0])
+    for group in np.split(order, starts[1:]):
+        h, w = hh[group[0]], ww[group[0]]
+        aa, bb = window_pixels(h, w)
+        for idx in np.array_split(group, -(-len(group)//batch_size)):
+            print('first k pixels %d'%(idx[0]))
+            hat_k = np.full((len(idx), h*w), np.nan, dtype=np.float32)
+            # uniform windows have no signal to filter (and a zero Cy)
+            win_ = (i_lo[idx,np.newaxis]+aa, j_lo[idx,np.newaxis]+bb)
+            keep = pixel_var[win_].sum(axis=1) > 1e-10*pixel_msq[win_].sum(axis=1)
+            if keep.any():
+                idx_ = idx[keep]
+                Cy = window_covariances(C_lags, i_lo[idx_], j_lo[idx_], h, w, gHalf=gHalf)
+                n_ = np.arange(len(idx_))
+                rhs = Cy[n_, neuron_indx[idx_], :]
+                rhs[n_, neuron_indx[idx_]] -= sn[ii[idx_], jj[idx_]]**2
+                hat_k[keep] = wiener_weights(Cy, rhs)
+            # uniform and degenerate windows keep the pixel as it is
+            skip = ~np.isfinite(hat_k).all(axis=1)
+            Y_rows[idx[skip]] = Y_[ii[idx[skip]], jj[idx[skip]]]
+            for p in idx[skip]:
+                k_hats[p] = []
+            idx, hat_k = idx[~skip], hat_k[~skip]
+            # filtered center = sum over window pixels of hat_k * pixel trace
+            for k, (a, b) in enumerate(zip(aa, bb)):
+                Y_rows[idx] += hat_k[:, k, np.newaxis] * Y_[i_lo[idx]+a, j_lo[idx]+b]
+            for p, k_hat in zip(idx, hat_k):
+                k_hats[p] = k_hat
+    Y_rows += mean_[ii, jj]
+    return Y_rows.reshape((len(rows), d2, T)), k_hats
+
+
+def spatial_filter_block(data,sn=None,maps=None,neuron_indx=None,Cy=None,center=None):
     """
     Apply wiener filter to block in data d1 x d2 x T
+    Cy: covariance of the block pixels ('C' order), computed from data if None
+    center: (cc1, cc2) pixel to filter, only its trace (T,) is returned
     """
-    data = np.asarray(data)
+    data = np.asarray(data, dtype=np.float32)
     dims = data.shape
+    if center is not None:
+        neuron_indx = int(center[0]*dims[1] + center[1])
     mean_ = data.mean(2,keepdims=True)
     data_ = data - mean_
+    # uniform block: nothing to filter and Cy would be singular
+    if data_.var(axis=2).sum() <= 1e-10*np.square(data).mean(axis=2).sum():
+        if center is not None:
+            return data[center[0],center[1]] , []
+        return data , []
 
     if sn is None:
         # sn, _ = cm.source_extraction.cnmf.pre_processing.get_noise_fft(data_,noise_method='mean')
         sn, _ = get_noise_fft(data_,noise_method='mean')
 
-    sn = sn.reshape(np.prod(dims[:2]),order='F')
+    # 'C' order keeps the reshapes views of the block
+    sn = np.asarray(sn, dtype=np.float32).reshape(np.prod(dims[:2]))
     D = np.diag(sn**2)
-    data_r = data_.reshape((np.prod(dims[:2]),dims[2]),order='F')
-    Cy = covariance_matrix(data_r)
-    Cy = Cy.copy()
+    data_r = data_.reshape((np.prod(dims[:2]),dims[2]))
+    if Cy is None:
+        Cy = covariance_matrix(data_r)
+    if neuron_indx is None:
+        rhs = Cy-D
+    else:
+        rhs = Cy[neuron_indx,:]-D[neuron_indx,:]
+    # Cy is symmetric positive (semi-)definite: solve with Cholesky instead of inverting,
+    # with the same ridge relative to the mean variance as wiener_weights
+    ridge = 1e-6*np.trace(Cy)/len(Cy)
     try:
-        if neuron_indx is None:
-            hat_k = np.linalg.inv(Cy).dot(Cy-D)
-        else:
-            hat_k = np.linalg.inv(Cy).dot(Cy[neuron_indx,:]-D[neuron_indx,:])
-    except np.linalg.linalg.LinAlgError as err:
+        c_low = sp.linalg.cho_factor(Cy + ridge*np.eye(len(Cy), dtype=Cy.dtype), lower=True, check_finite=False)
+        hat_k = sp.linalg.cho_solve(c_low, rhs, check_finite=False)
+    except np.linalg.LinAlgError as err:
         print('Singular matrix--')
-        return data , []
+        hat_k = np.linalg.lstsq(Cy, rhs, rcond=None)[0]
+    if center is not None:
+        # only the center trace is needed, skip the block sized output
+        y_row = np.einsum('k,kt->t', hat_k, data_r)
+        y_row += mean_[center[0],center[1],0]
+        return y_row , hat_k
     if neuron_indx is None:
         y_ = hat_k.dot(data_r)
     else:
-        y_ = data_r.copy()
-        y_[neuron_indx,:] = hat_k[:,np.newaxis].T.dot(data_r)
-    y_hat = y_.reshape(dims[:2]+(dims[2],),order='F')
+        # data_r is a view of the local data_, update the center row in place
+        y_ = data_r
+        y_[neuron_indx,:] = np.einsum('k,kt->t', hat_k, data_r)
+    y_hat = y_.reshape(dims[:2]+(dims[2],))
     y_hat = y_hat + mean_
-    Cn_y = local_correlations_fft(data)
-    Cn_yh = local_correlations_fft(y_hat)
     return y_hat , hat_k
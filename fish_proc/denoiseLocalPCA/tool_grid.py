@@ -394,27 +394,26 @@ def run_single(Y,
             Yds[ii]=resultdict[0]
             vtids[ii]=resultdict[1]
     else: # multiprocessing coondition
+        from joblib import Parallel, delayed
         get_process_memory();
-        cpu_count = multiprocessing.cpu_count()        
-        pool = multiprocessing.Pool(cpu_count)
-        args=[[patch] for patch in Y]
+        cpu_count = multiprocessing.cpu_count()
+        func = partial(gpca.denoise_patch,
+                       maxlag=maxlag,
+                       confidence=confidence,
+                       greedy=greedy,
+                       fudge_factor=fudge_factor,
+                       mean_th_factor=mean_th_factor,
+                       U_update=U_update,
+                       min_rank=min_rank,
+                       stim_knots=stim_knots,
+                       stim_delta=stim_delta)
+        # patches above max_nbytes are memory-mapped for the workers instead of pickled
+        # copy-on-write mode so the workers never write back into the dump
+        c_outs = Parallel(n_jobs=cpu_count, backend='loky', max_nbytes='50M',
+                          mmap_mode='c')(delayed(func)(patch) for patch in Y)
         Y = None
         clear_variables(Y)
         get_process_memory();
-        # define params in function
-        c_outs = pool.starmap(partial(gpca.denoise_patch,
-                                      maxlag=maxlag,
-                                      confidence=confidence,
-                                      greedy=greedy,
-                                      fudge_factor=fudge_factor,
-                                      mean_th_factor=mean_th_factor,
-                                      U_update=U_update,
-                                      min_rank=min_rank,
-                                      stim_knots=stim_knots,
-                                      stim_delta=stim_delta),
-                              args)
-        pool.close()
-        pool.join()
         Yds = [out_[0] for out_ in c_outs]
         vtids = [out_[1] for out_ in c_outs]
         c_outs = None
@@ -132,6 +132,27 @@ def axcov(data, maxlag=10):
     return np.real(np.divide(xcov, T))
 
 
+
+def axcov_rows(data, maxlag=10):
+    """
+    Same as axcov, applied to every row of data (k x T)
+    with a single batched FFT.
+
+    Output:
+    -------
+    axcov : array (k x 2*maxlag+1)
+        Autocovariances computed from -maxlag:0:maxlag
+    """
+
+    data = data - np.mean(data, axis=1, keepdims=True)
+    T = data.shape[1]
+    nfft = np.power(2, nextpow2(2 * T - 1))
+    xcov = np.fft.rfft(data, nfft, axis=1)
+    xcov = np.fft.irfft(np.square(np.abs(xcov)), nfft, axis=1)
+    xcov = np.concatenate([xcov[:, nfft - maxlag:],
+                           xcov[:, :maxlag + 1]], axis=1)
+    return np.divide(xcov, T)
+
 #### SOME FILTERS
 
 
@@ -7,8 +7,7 @@ from skimage.io import imsave
 
 def pixel_denoise(folderName, imgFileName, fishName, cameraNoiseMat, plot_en=False):
     from ..utils import getCameraInfo
-    from ..pixelwiseDenoising.simpleDenioseTool import simpleDN
-    from scipy.ndimage.filters import median_filter
+    from ..pixelwiseDenoising.simpleDenioseTool import simpleDN, medianBlurStack
     from skimage import io
     from ..utils.memory import clear_variables
     import os
@@ -34,15 +33,14 @@ def pixel_denoise(folderName, imgFileName, fishName, cameraNoiseMat, plot_en=Fal
     clear_variables(imgStack)
     ## smooth dead pixels
     win_ = 3
-    imgD_ = median_filter(imgD, size=(1, win_, win_))
+    imgD_ = medianBlurStack(imgD, win_=win_)
     # np.save(fishName+'/imgDNoMotion', imgD_)
     imsave(fishName+'/imgDNoMotion.tif', imgD_, compress=1)
     return imgD_
 
 def pixel_denoise_img_seq(folderName, fishName, cameraNoiseMat, plot_en=False):
     from ..utils import getCameraInfo
-    from ..pixelwiseDenoising.simpleDenioseTool import simpleDN
-    from scipy.ndimage.filters import median_filter
+    from ..pixelwiseDenoising.simpleDenioseTool import simpleDN, medianBlurStack
     from glob import glob
     from skimage import io
 
@@ -65,7 +63,7 @@ def pixel_denoise_img_seq(folderName, fishName, cameraNoiseMat, plot_en=False):
     imgD = simpleDN(imgStack, offset=offset_, gain=gain_)
     ## smooth dead pixels
     win_ = 3
-    imgD_ = median_filter(imgD, size=(1, win_, win_))
+    imgD_ = medianBlurStack(imgD, win_=win_)
     # np.save(fishName+'/imgDNoMotion', imgD_)
     imsave(fishName+'/imgDNoMotion.tif', imgD_, compress=1)
     return imgD_
@@ -77,6 +77,23 @@ def simpleDN(img, folder_name='../pixelwiseDenoising/gainMat20180208', pixel_x=N
     imgD[imgD <= 0] = 1e-6
     return imgD
 
+def medianBlurStack(img, win_=3):
+    """
+    Median filter each (x, y) frame of img, i.e. median_filter with
+    size (1, ..., win_, win_). For float32 stacks and win_=3 the frames
+    go through cv2.medianBlur, whose replicated border equals the scipy
+    'reflect' border for a 3x3 window; otherwise scipy is used.
+    """
+    if win_ != 3 or img.dtype != np.float32:
+        from scipy.ndimage.filters import median_filter
+        return median_filter(img, size=(1,)*(img.ndim-2)+(win_, win_))
+    import cv2
+    frames = np.ascontiguousarray(img).reshape((-1,)+img.shape[-2:])
+    imgD = np.empty_like(frames)
+    for n_, frame in enumerate(frames):
+        cv2.medianBlur(frame, win_, dst=imgD[n_])
+    return imgD.reshape(img.shape)
+
 def smoothDeadPixelBoxCar(img):
     from scipy.signal import convolve2d
     win_size = 1
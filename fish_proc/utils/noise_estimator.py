@@ -30,32 +30,47 @@ def resize(Y, size, interpolation=cv2.INTER_AREA):
         raise NotImplementedError
     return
 
-def noise_estimator(Y,range_ff=[0.25,0.5],method='logmexp'):
+def psd_reducer(method='logmexp'):
+    """
+    Noise level from the in-band power spectral density (last axis),
+    chosen once per call instead of per pixel
+    """
+    if method == 'mean':
+        return lambda Pxx_ind: np.sqrt(np.mean(np.divide(Pxx_ind, 2), axis=-1))
+    elif method == 'median':
+        return lambda Pxx_ind: np.sqrt(np.median(np.divide(Pxx_ind, 2), axis=-1))
+    elif method == 'logmexp':
+        return lambda Pxx_ind: np.sqrt(np.exp(np.mean(np.log(np.divide(Pxx_ind, 2)), axis=-1)))
+    raise KeyError(method)
+
+def psd_band(ff, range_ff=[0.25,0.5]):
+    """
+    Slice of the sorted frequencies ff with range_ff[0] < ff < range_ff[1]
+    """
+    return slice(np.searchsorted(ff, range_ff[0], side='right'),
+                 np.searchsorted(ff, range_ff[1], side='left'))
+
+def noise_estimator(Y,range_ff=[0.25,0.5],method='logmexp',batch_size=None):
     dims = Y.shape
+    if batch_size is None:
+        # about 2**20 samples per Welch call, its scratch is several times the batch
+        batch_size = max(1, 2**20//dims[-1])
     if len(dims)>2:
         V_hat = Y.reshape((np.prod(dims[:2]),dims[2]),order='F')
     else:
-        V_hat = Y.copy()
-    sns = []
-    for i in range(V_hat.shape[0]):
-        if np.count_nonzero(V_hat[i,:]):
-            # skip the computation for pure zero vectors
-            ff, Pxx = sp.signal.welch(V_hat[i,:],nperseg=min(256,dims[-1]))
-            ind1 = ff > range_ff[0]
-            ind2 = ff < range_ff[1]
-            ind = np.logical_and(ind1, ind2)
-            #Pls.append(Pxx)
-            #ffs.append(ff)
-            Pxx_ind = Pxx[ind]
-            sn = {
-                'mean': lambda Pxx_ind: np.sqrt(np.mean(np.divide(Pxx_ind, 2))),
-                'median': lambda Pxx_ind: np.sqrt(np.median(np.divide(Pxx_ind, 2))),
-                'logmexp': lambda Pxx_ind: np.sqrt(np.exp(np.mean(np.log(np.divide(Pxx_ind, 2)))))
-            }[method](Pxx_ind)
-            sns.append(sn)
-        else:
-            sns.append(0)
-    sns = np.asarray(sns)
+        V_hat = Y
+    reducer = psd_reducer(method)
+    # skip the computation for pure zero vectors
+    nonzero = np.flatnonzero(np.count_nonzero(V_hat, axis=-1))
+    sns = np.zeros(V_hat.shape[0])
+    # Welch over batches of pixels, bounding the memory of the segments
+    for n_ in range(0, len(nonzero), batch_size):
+        rows = nonzero[n_:n_+batch_size]
+        ff, Pxx = sp.signal.welch(V_hat[rows],nperseg=min(256,dims[-1]),axis=-1)
+        sn = reducer(Pxx[:, psd_band(ff, range_ff)])
+        if n_ == 0:
+            sns = sns.astype(sn.dtype)
+        sns[rows] = sn
     if len(dims)>2:
         sns = sns.reshape(dims[:2],order='F')
     return sns
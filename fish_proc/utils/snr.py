@@ -2,18 +2,25 @@ import numpy as np
 
 def correlation_pnr(Y, remove_small_val =False, remove_small_val_th =3, skip_pnr=False, skip_cn=False):
     from .np_mp import parallel_to_chunks
-    Y = Y - Y.mean(axis=-1,keepdims=True)
-    data_max = Y.max(axis=-1)
     cn, pnr = (None, None)
-    if not skip_pnr:
-        data_std, = parallel_to_chunks(noise_level, Y)
-        pnr = np.divide(data_max, data_std)
-        pnr[data_std==0]=0
-        if remove_small_val:
-            pnr[pnr < 0] = 0
+    if skip_pnr:
+        # local_correlations_fft removes the mean itself, no demeaned copy needed
+        if not skip_cn:
+            cn = local_correlations_fft(Y, swap_dim=True)
+        return cn, pnr
+    mean_ = Y.mean(axis=-1,keepdims=True)
+    # max(Y - mean) == max(Y) - mean, taken on the raw data
+    data_max = Y.max(axis=-1) - mean_[..., 0]
+    Y = Y - mean_
+    data_std, = parallel_to_chunks(noise_level, Y)
+    pnr = np.divide(data_max, data_std)
+    pnr[data_std==0]=0
+    if remove_small_val:
+        pnr[pnr < 0] = 0
     if not skip_cn:
         if remove_small_val:
-            Y = Y / data_std[:,:,np.newaxis]
+            # Y is already a local copy after the mean subtraction
+            Y /= data_std[:,:,np.newaxis]
             Y[Y < remove_small_val_th] = 0
         cn = local_correlations_fft(Y, swap_dim=True)
     return cn, pnr
@@ -24,16 +31,20 @@ def noise_level(mov_wf, range_ff =[0.25,0.5]):
     ndim_ = np.ndim(mov_wf)
     if ndim_==3:
         dims_ = mov_wf.shape
-        mov_wf = mov_wf.reshape((np.prod(dims_[:2]), dims_[2]),order='F')
+        # C-order keeps the reshape a view of the (contiguous) chunk
+        mov_wf = mov_wf.reshape((np.prod(dims_[:2]), dims_[2]))
     noise_level = noise_estimator.noise_estimator(mov_wf, range_ff=range_ff, method='logmexp')
     if ndim_ ==3:
-        noise_level = noise_level.reshape(dims_[:2], order='F')
+        noise_level = noise_level.reshape(dims_[:2])
     return noise_level,
 
 
 def local_correlations_fft(Y, eight_neighbours=True, swap_dim=True, opencv=True, is_mp=True):
+    import multiprocessing as mp
     from .np_mp import parallel_to_chunks
-    from scipy.ndimage.filters import convolve
+    if mp.current_process().daemon:
+        # pool workers cannot start a pool of their own
+        is_mp = False
     if swap_dim:
         Y = np.transpose(
             Y, tuple(np.hstack((Y.ndim - 1, list(range(Y.ndim))[:-1]))))
@@ -62,30 +73,92 @@ def local_correlations_fft(Y, eight_neighbours=True, swap_dim=True, opencv=True,
 
     if is_mp:
         sum_, = parallel_to_chunks(local_correlations_fft_slice_sum, Y, sz=sz, opencv=opencv, ndim=Y.ndim)
-        MASK = convolve(np.ones(Y.shape[1:], dtype='float32'), sz, mode='constant')
+        MASK = neighbours_convolve(np.ones(Y.shape[1:], dtype='float32'), sz)
         return sum_.sum(axis=0)/MASK/len_
     else:
         import cv2
-        from scipy.ndimage.filters import convolve
         if opencv and Y.ndim == 3:
-            Yconv = Y.copy()
-            for idx, img in enumerate(Yconv):
-                Yconv[idx] = cv2.filter2D(img, -1, sz, borderType=0)
+            import os
+            from concurrent.futures import ThreadPoolExecutor
+            Yconv = np.empty(Y.shape, dtype=Y.dtype)
+            ksep = eight_neighbours_kernel_1d(sz)
+            def _filt(idx):
+                # opencv releases the GIL, so frames are filtered concurrently
+                filter2D_neighbours(Y[idx], sz, Yconv[idx], ksep=ksep)
+            with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+                list(ex.map(_filt, range(len_)))
             MASK = cv2.filter2D(np.ones(Y.shape[1:], dtype='float32'), -1, sz, borderType=0)
         else:
-            Yconv = convolve(Y, sz[np.newaxis, :], mode='constant')
-            MASK = convolve(np.ones(Y.shape[1:], dtype='float32'), sz, mode='constant')
-        Cn = np.mean(Yconv * Y, axis=0) / MASK
+            import os
+            from concurrent.futures import ThreadPoolExecutor
+            # frames are independent: convolve chunks of frames on a thread pool,
+            # which also bounds the scratch memory to one chunk per thread
+            nchunks = min(len_, 4*(os.cpu_count() or 1))
+            with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+                sums_ = ex.map(lambda imgs: local_correlations_fft_slice_sum(imgs, sz=sz, opencv=False, ndim=Y.ndim)[0],
+                               np.array_split(Y, nchunks))
+                sum_ = np.sum(list(sums_), axis=0)[0]
+            MASK = neighbours_convolve(np.ones(Y.shape[1:], dtype='float32'), sz)
+            return sum_/MASK/len_
+        Yconv *= Y
+        Cn = np.mean(Yconv, axis=0) / MASK
         return Cn
 
 
 def local_correlations_fft_slice_sum(imgs, sz=np.ones((3,3)), opencv=True, ndim=3):
-    import cv2
-    from scipy.ndimage.filters import convolve
+    if not (opencv and ndim==3):
+        # one convolution over the whole chunk instead of a call per frame
+        conv = neighbours_convolve(imgs, sz[np.newaxis])
+        conv *= imgs
+        return conv.sum(axis=0, dtype='float64')[np.newaxis],
     sum_ = np.zeros(imgs.shape[1:])
+    # filter and product share one scratch frame instead of two temporaries
+    conv = np.empty(imgs.shape[1:], dtype=imgs.dtype)
+    ksep = eight_neighbours_kernel_1d(sz)
     for img in imgs:
-        if opencv and ndim==3:
-            sum_ += cv2.filter2D(img, -1, sz, borderType=0)*img
-        else:
-            sum_ += convolve(img, sz, mode='constant')*img
+        filter2D_neighbours(img, sz, conv, ksep=ksep)
+        np.multiply(conv, img, out=conv)
+        sum_ += conv
     return sum_[np.newaxis, :, :],
+
+
+def eight_neighbours_kernel_1d(sz):
+    """
+    Return the 1D kernel k (float32) with sz == outer(k, k) - center
+    if sz is the 3x3 eight-neighbour kernel, otherwise None.
+    Computed once per call so the frame loops only run sepFilter2D.
+    """
+    sz = np.asarray(sz)
+    if sz.shape == (3, 3) and sz[1, 1] == 0 and (sz == 1).sum() == 8:
+        return np.ones((3, 1), dtype='float32')
+    return None
+
+
+def filter2D_neighbours(img, sz, dst, ksep=None):
+    import cv2
+    if ksep is None:
+        cv2.filter2D(img, -1, sz, dst=dst, borderType=0)
+    else:
+        # separable 3x3 sum minus the center pixel
+        cv2.sepFilter2D(img, -1, ksep, ksep, dst=dst, borderType=0)
+        np.subtract(dst, img, out=dst)
+    return dst
+
+
+def neighbours_convolve(imgs, sz):
+    """
+    Same as scipy convolve(imgs, sz, mode='constant').
+    The eight-neighbour kernel (3x..x3 ones with a zero center, possibly
+    with leading singleton axes) is computed as a separable box filter
+    minus the center instead of a dense convolution.
+    """
+    from scipy.ndimage.filters import convolve, uniform_filter
+    sz = np.asarray(sz)
+    core = sz.reshape([_ for _ in sz.shape if _ != 1])
+    if core.ndim > 0 and all(_ == 3 for _ in core.shape) and \
+            core.flat[core.size//2] == 0 and (core == 1).sum() == core.size-1:
+        conv = uniform_filter(imgs, size=sz.shape, mode='constant')
+        conv *= core.size
+        conv -= imgs
+        return conv
+    return convolve(imgs, sz, mode='constant')
@@ -3,8 +3,7 @@ import os, sys
 
 
 def pixelDenoiseImag(img, cameraNoiseMat='', cameraInfo=None):
-    from ..pixelwiseDenoising.simpleDenioseTool import simpleDN
-    from scipy.ndimage.filters import median_filter
+    from ..pixelwiseDenoising.simpleDenioseTool import simpleDN, medianBlurStack
     win_ = 3
     pixel_x0, pixel_x1, pixel_y0, pixel_y1 = [int(_) for _ in cameraInfo['camera_roi'].split('_')]
     pixel_x = (pixel_x0, pixel_x1)
@@ -15,8 +14,7 @@ def pixelDenoiseImag(img, cameraNoiseMat='', cameraInfo=None):
     gain_ = gain[pixel_x[0]:pixel_x[1], pixel_y[0]:pixel_y[1]]
     if img.ndim == 3:
         img = np.expand_dims(img, axis=1) # insert z dim here
-    filter_win = (1, 1, win_, win_)
-    return median_filter(simpleDN(img, offset=offset_, gain=gain_), size=filter_win)
+    return medianBlurStack(simpleDN(img, offset=offset_, gain=gain_), win_=win_)
 
 
 def load_bz2file(file, dims):
@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+# fish_proc.utils.noise_estimator needs opencv
+pytest.importorskip('cv2')
+from fish_proc.denoiseLocalPCA import spatial_filtering as sf  # noqa: E402
+
+
+def test_spatial_filter_image_matches_block():
+    # batched image filter against the single-window filter of every pixel,
+    # including border windows and windows touching a uniform patch
+    rng = np.random.RandomState(0)
+    d1, d2, T = 9, 8, 300
+    gHalf = [2, 1]
+    sig = np.sin(np.arange(T)/15.)[None, None, :]*rng.rand(d1, d2, 1)
+    Y = (3*sig + rng.randn(d1, d2, T) + 10).astype('float32')
+    Y[:3, :3] = 4.
+    sn = rng.rand(d1, d2).astype('float32') + 0.5
+
+    Y_wf, k_hats = sf.spatial_filter_image(Y, gHalf=gHalf, sn=sn, is_mp=False)
+    assert Y_wf.shape == Y.shape
+    for i in range(d1):
+        for j in range(d2):
+            ijSig = [[max(i-gHalf[0], 0), min(i+gHalf[0]+1, d1)],
+                     [max(j-gHalf[1], 0), min(j+gHalf[1]+1, d2)]]
+            win_ = tuple(slice(*a) for a in ijSig)
+            y_, k_hat = sf.spatial_filter_block(Y[win_], sn=sn[win_],
+                                                center=(i-ijSig[0][0], j-ijSig[1][0]))
+            np.testing.assert_allclose(Y_wf[i, j], y_, rtol=1e-4, atol=1e-3)
+            np.testing.assert_allclose(k_hats[i*d2+j], k_hat, rtol=1e-3, atol=1e-4)
+    # windows inside the uniform patch are passed through
+    np.testing.assert_array_equal(Y_wf[0, 0], Y[0, 0])
+    assert len(k_hats[0]) == 0